@@ -0,0 +1,106 @@
+"""Converts SatNet TFRecord shards into standardized float16 images.
+
+The converted records are read by train.py with --pre_casted, which skips
+the per-epoch decode, standardization, and cast of every example.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import argparse
+import tensorflow as tf
+
+# Import the SatNet decoding and the pre-casted record format.
+from dataset.dataset_generator import decode_satnet_example
+from dataset.dataset_generator import serialize_precast_example
+
+
+def _convert_shard(input_tfrecord_name, output_tfrecord_name, num_channels):
+
+    # Build each shard in its own graph so the iterators do not pile up.
+    with tf.Graph().as_default():
+
+        # Reuse the training decode so the converted images match training.
+        dataset = tf.data.TFRecordDataset(input_tfrecord_name)
+        dataset = dataset.map(lambda example_proto: decode_satnet_example(
+            example_proto, num_channels, standardize=True))
+        image = dataset.make_one_shot_iterator().get_next()
+
+        num_examples = 0
+        with tf.Session() as sess, \
+                tf.python_io.TFRecordWriter(output_tfrecord_name) as writer:
+            while True:
+                try:
+                    image_value = sess.run(image)
+                except tf.errors.OutOfRangeError:
+                    break
+                writer.write(serialize_precast_example(image_value))
+                num_examples += 1
+
+    return num_examples
+
+
+def main(FLAGS):
+
+    input_tfrecord_names = sorted(tf.gfile.Glob(
+        os.path.join(FLAGS.dataset_path, FLAGS.input_tfrecord)))
+
+    if not input_tfrecord_names:
+        raise ValueError('No TFRecord files match ' + FLAGS.input_tfrecord)
+
+    output_path = FLAGS.output_path or FLAGS.dataset_path
+    if not tf.gfile.Exists(output_path):
+        tf.gfile.MakeDirs(output_path)
+
+    # Write one converted shard per input shard, so the output keeps the
+    # input's sharding and can be read back with the same glob.
+    for input_tfrecord_name in input_tfrecord_names:
+        root, ext = os.path.splitext(os.path.basename(input_tfrecord_name))
+
+        # Skip shards that a previous run already converted.
+        if root.endswith(FLAGS.output_suffix):
+            continue
+
+        output_tfrecord_name = os.path.join(output_path,
+                                            root + FLAGS.output_suffix + ext)
+        num_examples = _convert_shard(input_tfrecord_name,
+                                      output_tfrecord_name,
+                                      FLAGS.num_channels)
+
+        print("Wrote " + str(num_examples) + " examples to " +
+              output_tfrecord_name)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset_path', type=str,
+                        default="C:\\research\\data\\satnet\\",
+                        help='Path to the TFRecord files.')
+
+    parser.add_argument('--input_tfrecord', type=str,
+                        default="desequenced_train_rn_16mc.tfrecords",
+                        help='Name or glob pattern of the SatNet TFRecord '
+                             'shards to convert.')
+
+    parser.add_argument('--output_path', type=str,
+                        default=None,
+                        help='Directory for the converted shards. Defaults '
+                             'to --dataset_path.')
+
+    parser.add_argument('--output_suffix', type=str,
+                        default="_fp16",
+                        help='Suffix appended to each input shard name, '
+                             'before its extension, to name its output.')
+
+    parser.add_argument('--num_channels',
+                        type=int,
+                        default=1,
+                        help='Number of channels in the input data.')
+
+    FLAGS = parser.parse_args()
+
+    main(FLAGS)
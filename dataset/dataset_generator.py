@@ -19,20 +19,31 @@ class DatasetGenerator(object):
                  batch_size=4,
                  num_threads=1,
                  buffer=30,
-                 encoding_function=None):
+                 encoding_function=None,
+                 cache=False,
+                 num_readers=16,
+                 pre_casted=False,
+                 standardize=True):
         """
         Constructor for the data generator class. Takes as inputs many configuration choices, and returns a generator
         with those options set.
 
-        :param tfrecord_name: the name of the TFRecord to be processed.
+        :param tfrecord_name: the name of the TFRecord to be processed, or a glob pattern matching several shards.
         :param num_channels: the number of channels in the TFRecord images.
         :param augment: whether or not to apply augmentation to the processing chain.
         :param shuffle: whether or not to shuffle the input buffer.
         :param batch_size: the number of examples in each batch produced.
-        :param num_threads: the number of threads to use in processing input.
+        :param num_threads: the number of threads to use in processing input. If negative, the thread count and
+                            prefetch depth are chosen by the tf.data autotuner.
         :param buffer: the prefetch buffer size to use in processing.
         :param encoding_function: a custom encoding function to map from the raw image/bounding boxes to the desired
                                   format for one's specific network.
+        :param cache: whether or not to cache the decoded examples in memory after the first epoch.
+        :param num_readers: the number of TFRecord shards to read from concurrently.
+        :param pre_casted: whether the TFRecord holds standardized float16 images written by convert_tfrecord_float.py,
+                           rather than raw SatNet images.
+        :param standardize: whether or not to standardize SatNet images in the pipeline. If False, the raw uint16
+                            images are produced, and the consumer is expected to standardize them on its own device.
         """
         self.num_channels = num_channels
         self.batch_size = batch_size
@@ -44,13 +55,19 @@ class DatasetGenerator(object):
         self.num_threads = num_threads
         self.buffer = buffer
         self.tfrecord_path = tfrecord_name
+        self.cache = cache
+        self.num_readers = num_readers
+        self.pre_casted = pre_casted
+        self.standardize = standardize
 
         self.dataset = self.build_pipeline(tfrecord_name,
                                            augment=augment,
                                            shuffle=shuffle,
                                            batch_size=batch_size,
                                            num_threads=num_threads,
-                                           buffer=buffer)
+                                           buffer=buffer,
+                                           cache=cache,
+                                           num_readers=num_readers)
 
     def get_dataset(self):
         return self.dataset
@@ -61,53 +78,15 @@ class DatasetGenerator(object):
 
     def _decode_satnet(self, example_proto):
         """
-        This is the first step of the generator/augmentation chain. Reading the raw file out of the TFRecord is fairly
-        straight-forward, though does require some simple fixes. For instance, the number of bounding boxes needs to be
-        padded to some upper bound so that the tensors are all of the same shape and can thus be batched.
+        Decodes a SatNet example with this generator's channel count and standardization settings.
 
         :param example_proto: Example from a TFRecord file
-        :return: The raw image and padded bounding boxes corresponding to this TFRecord example.
+        :return: The image corresponding to this TFRecord example.
         """
-        # Define how to parse the example
-        features = {
-            "width": tf.FixedLenFeature([], dtype=tf.int64),
-            "height": tf.FixedLenFeature([], dtype=tf.int64),
-            "images_raw": tf.VarLenFeature(dtype=tf.string),
-            "ymin": tf.VarLenFeature(tf.float32),
-            "ymax": tf.VarLenFeature(tf.float32),
-            "xmin": tf.VarLenFeature(tf.float32),
-            "xmax": tf.VarLenFeature(tf.float32),
-            "classes": tf.VarLenFeature(tf.int64),
-            "filename": tf.VarLenFeature(tf.string)
-        }
-
-        # Parse the example
-        features_parsed = tf.parse_single_example(serialized=example_proto, features=features)
-        width = tf.cast(features_parsed['width'], tf.int32)
-        height = tf.cast(features_parsed['height'], tf.int32)
-
-        ymin = tf.cast(tf.sparse.to_dense(features_parsed['ymin']), tf.float32)
-        ymax = tf.cast(tf.sparse.to_dense(features_parsed['ymax']), tf.float32)
-        xmin = tf.cast(tf.sparse.to_dense(features_parsed['xmin']), tf.float32)
-        xmax = tf.cast(tf.sparse.to_dense(features_parsed['xmax']), tf.float32)
-        classes = tf.cast(tf.sparse.to_dense(features_parsed['classes']), tf.float32)
-        bboxes = tf.stack([ymin, xmin, ymax, xmax, classes], axis=1)
-
-        # Because images can differ in number of bounding boxes, we need to pad to the same size
-        # Before: bboxes is N X 5 where N is the number of boxes in that image
-        paddings = tf.constant([[0, self.max_boxes_per_image], [0, 0]])
-        paddings = paddings - (tf.constant([[0, 1], [0, 0]]) * tf.shape(bboxes)[0])
-        bboxes = tf.pad(bboxes, paddings, constant_values=0.0)
-
-        images = tf.sparse.to_dense(features_parsed['images_raw'], default_value="")
-        images = tf.decode_raw(images, tf.uint16)
-        print(self.num_channels)
-        images = tf.reshape(images, [height, width, self.num_channels])
-
-        # Normalize the image pixels to have zero mean and unit variance
-        images = tf.image.per_image_standardization(images)
-
-        return images
+        return decode_satnet_example(example_proto,
+                                     self.num_channels,
+                                     standardize=self.standardize,
+                                     max_boxes_per_image=self.max_boxes_per_image)
 
     def _decode_mnist(self, serialized_example):
         """Parses an image and label from the given `serialized_example`."""
@@ -130,50 +109,68 @@ class DatasetGenerator(object):
 
         return image
 
-    def build_pipeline(self, tfrecord_path, augment, shuffle, batch_size, num_threads, buffer):
+    def build_pipeline(self, tfrecord_path, augment, shuffle, batch_size, num_threads, buffer, cache=False,
+                       num_readers=16):
         """
         Reads in data from a TFRecord file, applies augmentation chain (if
         desired), shuffles and batches the data.
         Supports prefetching and multithreading, the intent being to pipeline
         the training process to lower latency.
 
-        :param tfrecord_path:
+        :param tfrecord_path: a TFRecord file name, or a glob pattern matching several TFRecord shards.
         :param augment: whether to augment data or not.
         :param shuffle: whether to shuffle data in buffer or not.
         :param batch_size: Number of examples in each batch returned.
-        :param num_threads: Number of parallel subprocesses to load data.
+        :param num_threads: Number of parallel subprocesses to load data, or negative to autotune.
         :param buffer: Number of images to prefetch in buffer.
+        :param cache: whether to cache the decoded examples in memory or not.
+        :param num_readers: Number of TFRecord shards to read from concurrently.
         :return: the next batch, to be provided when this generator is run (see
         run_generator())
         """
 
-        # Create the TFRecord dataset
-        data = tf.data.TFRecordDataset(tfrecord_path)
+        # A negative thread count hands the parallelism and prefetch depth over to the tf.data autotuner
+        if num_threads < 0:
+            num_threads = tf.data.experimental.AUTOTUNE
+            prefetch_buffer = tf.data.experimental.AUTOTUNE
+        else:
+            prefetch_buffer = buffer
+
+        # Create the TFRecord dataset, interleaving reads across every shard matching the path
+        files = tf.data.Dataset.list_files(tfrecord_path, shuffle=shuffle)
+        data = files.interleave(lambda filename: tf.data.TFRecordDataset(filename, buffer_size=8 << 20),
+                                cycle_length=num_readers,
+                                block_length=16,
+                                num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
         # Parse the record into tensors.
-        # data = data.map(self._decode_mnist, num_parallel_calls=num_threads).prefetch(buffer)
-        data = data.map(self._decode_satnet, num_parallel_calls=num_threads).prefetch(buffer)
+        # data = data.map(self._decode_mnist, num_parallel_calls=num_threads).prefetch(prefetch_buffer)
+        decode_function = decode_precast_example if self.pre_casted else self._decode_satnet
+        data = data.map(decode_function, num_parallel_calls=num_threads)
+
+        # Keep the decoded examples in memory, so the TFRecord is only parsed once rather than every epoch. This must
+        # come before augmentation, which is random and has to be re-applied each epoch.
+        if cache:
+            data = data.cache()
+
+        data = data.prefetch(prefetch_buffer)
 
         # If augmentation is to be applied
         if augment:
             # The only pixel-wise mutation possible on single channel imagery
-            data = data.map(_vary_contrast, num_parallel_calls=num_threads).prefetch(buffer)
+            data = data.map(_vary_contrast, num_parallel_calls=num_threads).prefetch(prefetch_buffer)
 
             # Technically, we only need rotation and one flip to get all possible orientations. But they are all here
             # anyways because it makes me feel better.
-            data = data.map(_flip_left_right, num_parallel_calls=num_threads).prefetch(buffer)
-            data = data.map(_flip_up_down, num_parallel_calls=num_threads).prefetch(buffer)
-            data = data.map(_rotate_random, num_parallel_calls=num_threads).prefetch(buffer)
+            data = data.map(_flip_left_right, num_parallel_calls=num_threads).prefetch(prefetch_buffer)
+            data = data.map(_flip_up_down, num_parallel_calls=num_threads).prefetch(prefetch_buffer)
+            data = data.map(_rotate_random, num_parallel_calls=num_threads).prefetch(prefetch_buffer)
 
             # 50/50 chance of performing some crop, which is then randomly determined
-            # data = data.map(_crop_random, num_parallel_calls=num_threads).prefetch(buffer)
+            # data = data.map(_crop_random, num_parallel_calls=num_threads).prefetch(prefetch_buffer)
 
         # If we decide to force all images to the same size, this line can be used
-        # data = data.map(_resize_data, num_parallel_calls=num_threads).prefetch(buffer)
-
-        # If the destination network requires a special encoding, do that here
-        if self.encode_for_network is not None:
-            data = data.map(self.encode_for_network, num_parallel_calls=num_threads).prefetch(buffer)
+        # data = data.map(_resize_data, num_parallel_calls=num_threads).prefetch(prefetch_buffer)
 
         if shuffle:
             data = data.shuffle(buffer)
@@ -181,13 +178,127 @@ class DatasetGenerator(object):
         # Repeat the data forever (i.e. as many epochs as we desire)
         data = data.repeat()
 
-        # Batch the data
-        data = data.batch(batch_size)
+        # If the destination network requires a special encoding, do that here. tf.data fuses it with the batching
+        # below (see the options at the end of the pipeline).
+        if self.encode_for_network is not None:
+            data = data.map(self.encode_for_network, num_parallel_calls=num_threads)
+
+        # Batch the data. The data repeats forever, so dropping the remainder never drops an example, but it does give
+        # the batch dimension a static size.
+        data = data.batch(batch_size, drop_remainder=True)
+
+        # Overlap producing the next batch with consuming the current one
+        data = data.prefetch(prefetch_buffer)
+
+        # Let tf.data fuse adjacent transformations
+        options = tf.data.Options()
+        options.experimental_optimization.map_and_batch_fusion = True
+        data = data.with_options(options)
 
         # Return a reference to this data pipeline
         return data
 
 
+def decode_satnet_example(example_proto, num_channels, standardize=True, max_boxes_per_image=10):
+    """
+    This is the first step of the generator/augmentation chain. Reading the raw file out of the TFRecord is fairly
+    straight-forward, though does require some simple fixes. For instance, the number of bounding boxes needs to be
+    padded to some upper bound so that the tensors are all of the same shape and can thus be batched.
+
+    :param example_proto: Example from a TFRecord file
+    :param num_channels: the number of channels in the TFRecord images.
+    :param standardize: whether or not to standardize the image, rather than returning the raw uint16 pixels.
+    :param max_boxes_per_image: the number of bounding boxes to pad to.
+    :return: The image corresponding to this TFRecord example.
+    """
+    # Define how to parse the example
+    features = {
+        "width": tf.FixedLenFeature([], dtype=tf.int64),
+        "height": tf.FixedLenFeature([], dtype=tf.int64),
+        "images_raw": tf.VarLenFeature(dtype=tf.string),
+        "ymin": tf.VarLenFeature(tf.float32),
+        "ymax": tf.VarLenFeature(tf.float32),
+        "xmin": tf.VarLenFeature(tf.float32),
+        "xmax": tf.VarLenFeature(tf.float32),
+        "classes": tf.VarLenFeature(tf.int64),
+        "filename": tf.VarLenFeature(tf.string)
+    }
+
+    # Parse the example
+    features_parsed = tf.parse_single_example(serialized=example_proto, features=features)
+    width = tf.cast(features_parsed['width'], tf.int32)
+    height = tf.cast(features_parsed['height'], tf.int32)
+
+    ymin = tf.cast(tf.sparse.to_dense(features_parsed['ymin']), tf.float32)
+    ymax = tf.cast(tf.sparse.to_dense(features_parsed['ymax']), tf.float32)
+    xmin = tf.cast(tf.sparse.to_dense(features_parsed['xmin']), tf.float32)
+    xmax = tf.cast(tf.sparse.to_dense(features_parsed['xmax']), tf.float32)
+    classes = tf.cast(tf.sparse.to_dense(features_parsed['classes']), tf.float32)
+    bboxes = tf.stack([ymin, xmin, ymax, xmax, classes], axis=1)
+
+    # Because images can differ in number of bounding boxes, we need to pad to the same size
+    # Before: bboxes is N X 5 where N is the number of boxes in that image
+    paddings = tf.constant([[0, max_boxes_per_image], [0, 0]])
+    paddings = paddings - (tf.constant([[0, 1], [0, 0]]) * tf.shape(bboxes)[0])
+    bboxes = tf.pad(bboxes, paddings, constant_values=0.0)
+
+    images = tf.sparse.to_dense(features_parsed['images_raw'], default_value="")
+    images = tf.decode_raw(images, tf.uint16)
+    images = tf.reshape(images, [height, width, num_channels])
+
+    # Normalize the image pixels to have zero mean and unit variance
+    if standardize:
+        images = tf.image.per_image_standardization(images)
+
+    return images
+
+
+def decode_precast_example(example_proto):
+    """
+    Reads an example written by serialize_precast_example. The image was standardized and cast to float16 offline, so
+    all that remains is to reinterpret the raw bytes and restore the stored image shape.
+
+    :param example_proto: Example from a TFRecord file
+    :return: The standardized float16 image corresponding to this TFRecord example.
+    """
+    features = {
+        "height": tf.FixedLenFeature([], dtype=tf.int64),
+        "width": tf.FixedLenFeature([], dtype=tf.int64),
+        "channels": tf.FixedLenFeature([], dtype=tf.int64),
+        "image_raw": tf.FixedLenFeature([], dtype=tf.string)
+    }
+
+    features_parsed = tf.parse_single_example(serialized=example_proto, features=features)
+    width = tf.cast(features_parsed['width'], tf.int32)
+    height = tf.cast(features_parsed['height'], tf.int32)
+    channels = tf.cast(features_parsed['channels'], tf.int32)
+
+    image = tf.decode_raw(features_parsed['image_raw'], tf.float16)
+    image = tf.reshape(image, [height, width, channels])
+
+    return image
+
+
+def serialize_precast_example(image):
+    """
+    Serializes a standardized image for reading back with pre_casted=True. The image is stored as raw float16 bytes
+    alongside its shape.
+
+    :param image: numpy array of Shape = Height X Width X Number of Channels
+    :return: the serialized tf.train.Example
+    """
+    image = image.astype("float16")
+    height, width, channels = image.shape
+    features = {
+        "height": tf.train.Feature(int64_list=tf.train.Int64List(value=[height])),
+        "width": tf.train.Feature(int64_list=tf.train.Int64List(value=[width])),
+        "channels": tf.train.Feature(int64_list=tf.train.Int64List(value=[channels])),
+        "image_raw": tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()]))
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=features))
+    return example.SerializeToString()
+
+
 def _vary_contrast(image, bboxs):
     """
     Randomly varies the pixel-wise contrast of the image. This is the only pixel-wise augmentation that can be performed
@@ -0,0 +1,28 @@
+"""Tests for dataset.dataset_generator."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+import tensorflow as tf
+from dataset import dataset_generator
+
+
+class PrecastExampleTest(tf.test.TestCase):
+
+  def test_precast_round_trip(self):
+    image = np.arange(24, dtype=np.float16).reshape([2, 4, 3]) / 7
+    serialized = dataset_generator.serialize_precast_example(image)
+    decoded = dataset_generator.decode_precast_example(tf.constant(serialized))
+
+    with self.test_session() as sess:
+      decoded_value = sess.run(decoded)
+
+    self.assertEqual(np.float16, decoded_value.dtype)
+    self.assertAllEqual(image, decoded_value)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -38,6 +38,7 @@ from dataset.dataset_generator import DatasetGenerator
 
 tfgan = tf.contrib.gan
 
+
 def _learning_rate(gan_type):
     # First is generator learning rate, second is discriminator learning rate.
     return {
@@ -46,6 +47,103 @@ def _learning_rate(gan_type):
         'infogan': (0.001, 9e-5),
     }[gan_type]
 
+
+class _GradientAccumulationOptimizer(tf.train.Optimizer):
+    """Applies the mean of several steps' gradients with another optimizer.
+
+    Each call to `apply_gradients` adds the gradients to per-variable
+    accumulators. Every `accum_steps` calls, the wrapped optimizer applies the
+    averaged gradients and the accumulators are reset.
+    """
+
+    def __init__(self, optimizer, accum_steps, name='GradientAccumulation'):
+        super(_GradientAccumulationOptimizer, self).__init__(False, name)
+        self._optimizer = optimizer
+        self._accum_steps = accum_steps
+
+    def compute_gradients(self, *args, **kwargs):
+        return self._optimizer.compute_gradients(*args, **kwargs)
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        # The loss scale optimizer calls this inside a cond, so lift the
+        # accumulators out of it to keep their initializers usable.
+        with tf.init_scope():
+            accumulators = [self._zeros_slot(v, 'accumulator', self._name)
+                            for _, v in grads_and_vars]
+            accum_step = tf.Variable(0, dtype=tf.int64, trainable=False,
+                                     name='accumulation_step')
+
+        accumulate_ops = [accumulator.assign_add(tf.convert_to_tensor(g))
+                          for accumulator, (g, _) in zip(accumulators,
+                                                         grads_and_vars)]
+        with tf.control_dependencies(accumulate_ops):
+            step = accum_step.assign_add(1)
+
+        def _apply_and_reset():
+            mean_grads_and_vars = [(accumulator / self._accum_steps, v)
+                                   for accumulator, (_, v) in zip(accumulators,
+                                                                  grads_and_vars)]
+            apply_op = self._optimizer.apply_gradients(mean_grads_and_vars,
+                                                       global_step=global_step)
+            with tf.control_dependencies([apply_op]):
+                reset_op = tf.group(*[accumulator.assign(tf.zeros_like(accumulator))
+                                      for accumulator in accumulators])
+            with tf.control_dependencies([reset_op]):
+                return tf.constant(True)
+
+        applied = tf.cond(tf.equal(step % self._accum_steps, 0),
+                          _apply_and_reset,
+                          lambda: tf.constant(False))
+        return tf.group(applied, name=name)
+
+
+def _optimizer(learning_rate, dtype, accum_steps=1):
+    # tf.train.AdamOptimizer already updates each variable with a single fused
+    # ApplyAdam kernel, so it is used directly rather than a contrib/addons
+    # replacement. For FP16, rewrite the graph to compute with FP32 master
+    # weights, using dynamic loss scaling to keep gradients in range.
+    optimizer = tf.train.AdamOptimizer(learning_rate, 0.5)
+    if accum_steps > 1:
+        optimizer = _GradientAccumulationOptimizer(optimizer, accum_steps)
+    if dtype == 'fp16':
+        optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(
+            optimizer, loss_scale='dynamic')
+    return optimizer
+
+
+def _jit_compiled(network_fn):
+    # Builds the network inside an XLA jit scope, so its conv, normalization,
+    # and activation ops are fused into compiled kernels. Everything built
+    # outside the network function, such as the optimizer updates, is not.
+    def jit_network_fn(*args, **kwargs):
+        with tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=True):
+            return network_fn(*args, **kwargs)
+    return jit_network_fn
+
+
+def _noise_buffer(name, shape):
+    # Refills a preallocated noise variable in place each time it is read,
+    # seeded from a counter the buffer owns, so each draw reuses one buffer
+    # and this noise sequence is reproducible across runs. InfoGAN's
+    # structured codes are drawn separately and are not covered by this.
+    noise_var = tf.get_variable(name,
+                                shape=shape,
+                                dtype=tf.float32,
+                                initializer=tf.zeros_initializer(),
+                                trainable=False,
+                                collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    counter = tf.get_variable(name + '_counter',
+                              shape=[],
+                              dtype=tf.int64,
+                              initializer=tf.zeros_initializer(),
+                              trainable=False,
+                              collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    seed_step = counter.assign_add(1)
+    seed = tf.stack([seed_step, tf.constant(0, tf.int64)])
+    return noise_var.assign(tf.random.stateless_normal(shape, seed=seed))
+
+
 # Two core changes in Keras
 # Remove buggy error checks.
 def main(FLAGS):
@@ -54,10 +152,26 @@ def main(FLAGS):
     if not tf.gfile.Exists(FLAGS.train_log_dir):
         tf.gfile.MakeDirs(FLAGS.train_log_dir)
 
+    # Input shapes are fixed for the whole run, so let cuDNN autotune its
+    # convolution algorithms once and use its fastest fixed-shape kernels.
+    os.environ.setdefault("TF_CUDNN_USE_AUTOTUNE", "1")
+    os.environ.setdefault("TF_USE_CUDNN_BATCHNORM_SPATIAL_PERSISTENT", "1")
+    os.environ.setdefault("TF_ENABLE_WINOGRAD_NONFUSED", "1")
+
     # Restrict GPU usage to avoid stepping on other work.
     print("GPU List = " + str(FLAGS.gpu_list))
     os.environ["CUDA_VISIBLE_DEVICES"] = FLAGS.gpu_list
 
+    # The tfgan training loop predates tf.distribute, so the graph is built
+    # for a single device and any further GPUs would only be reserved.
+    if len(FLAGS.gpu_list.split(',')) > 1:
+        logging.warning('Training uses only the first of GPUs %s; run one job '
+                        'per GPU instead.', FLAGS.gpu_list)
+
+    # Request the automatic mixed precision rewrite for all sessions as well.
+    if FLAGS.dtype == 'fp16':
+        os.environ["TF_ENABLE_AUTO_MIXED_PRECISION_GRAPH_REWRITE"] = "1"
+
     # Force all input processing onto CPU in order to reserve the GPU for
     # the forward inference and back-propagation.
     with tf.name_scope('inputs'):
@@ -66,13 +180,10 @@ def main(FLAGS):
             train_tfrecord_name = os.path.join(FLAGS.dataset_path,
                                                FLAGS.train_tfrecord)
 
-
-            # Declare a helper function to cohere w/ the Generator.
-            def cast_image_to_float(image, bbox=[]):
-
-                return tf.cast(image, tf.float32)
-
             # Instantate a helper class, returns a standard TF DS Generator.
+            # Images leave the pipeline in their compact on-disk dtype, either
+            # raw uint16 or pre-casted float16, and are only converted to
+            # float32 once they reach the GPU.
             train_generator = DatasetGenerator(train_tfrecord_name,
                                                num_channels=FLAGS.num_channels,
                                                augment=FLAGS.augment_train_data,
@@ -80,37 +191,65 @@ def main(FLAGS):
                                                batch_size=FLAGS.batch_size,
                                                num_threads=FLAGS.num_dataset_threads,
                                                buffer=FLAGS.dataset_buffer_size,
-                                               encoding_function=cast_image_to_float)
-
-            # Build the iterator from the geenerator
-            train_iterator = train_generator.dataset.make_one_shot_iterator()
-
-            # Get a prototpye batch for pipeline construction.
-            images = train_iterator.get_next()
-
-            print("\n\n\n\n\n")
-            print(tf.shape(images))
-            print("\n\n\n\n\n")
+                                               cache=FLAGS.cache_train_data,
+                                               pre_casted=FLAGS.pre_casted,
+                                               standardize=False)
+
+            train_dataset = train_generator.dataset
+
+        # Stage batches into GPU memory ahead of time, overlapping the
+        # host-to-device copy with the previous training step. Checked after
+        # CUDA_VISIBLE_DEVICES is set, so an empty or "-1" list trains on CPU.
+        if tf.test.is_gpu_available():
+            train_dataset = train_dataset.apply(
+                tf.data.experimental.prefetch_to_device('/gpu:0',
+                                                        buffer_size=2))
+
+        # Build the iterator from the generator. Datasets prefetched to a
+        # device need an initializable iterator, which the training session
+        # runs as part of its local init op.
+        train_iterator = train_dataset.make_initializable_iterator()
+
+        # Get a prototpye batch for pipeline construction. Image sizes are
+        # read from each record, so only the batch and channel dimensions
+        # are static.
+        images = train_iterator.get_next()
+        images = tf.ensure_shape(images, [FLAGS.batch_size,
+                                          None,
+                                          None,
+                                          FLAGS.num_channels])
+
+        # Pre-casted records were standardized offline, raw ones are
+        # standardized here, after the narrower host-to-device copy.
+        if FLAGS.pre_casted:
+            images = tf.cast(images, tf.float32)
+        else:
+            images = tf.image.per_image_standardization(images)
+
+        # Optionally print each batch's shape as it is consumed.
+        if FLAGS.debug:
+            print_op = tf.print('Image batch shape:', tf.shape(images))
+            with tf.control_dependencies([print_op]):
+                images = tf.identity(images)
 
     # Set the mutual information weight penalty to 0, overriden if infogan.
     mutual_information_penalty_weight = 0.0
 
-    # Define the GANModel tuple. Optionally, condition the GAN on the label or
-    # use an InfoGAN to learn a latent representation.
+    # Select the network functions and generator inputs. Optionally, condition
+    # the GAN on the label or use an InfoGAN to learn a latent representation.
     if FLAGS.gan_type == 'unconditional':
-        gan_model = tfgan.gan_model(generator_fn=networks.unconditional_generator,
-                                    discriminator_fn=networks.unconditional_discriminator,
-                                    real_data=images,
-                                    generator_inputs=tf.random_normal([FLAGS.batch_size,
-                                                                       FLAGS.noise_dims]))
+        generator_fn = networks.unconditional_generator
+        discriminator_fn = networks.unconditional_discriminator
+        generator_inputs = _noise_buffer('noise_buffer',
+                                         [FLAGS.batch_size, FLAGS.noise_dims])
 
     # TODO: Deprecate or extend conditional GAN.
     elif FLAGS.gan_type == 'conditional':
-        noise = tf.random_normal([FLAGS.batch_size, FLAGS.noise_dims])
-        gan_model = tfgan.gan_model(generator_fn=networks.conditional_generator,
-                                    discriminator_fn=networks.conditional_discriminator,
-                                    real_data=images,
-                                    generator_inputs=(noise, one_hot_labels))
+        noise = _noise_buffer('noise_buffer',
+                              [FLAGS.batch_size, FLAGS.noise_dims])
+        generator_fn = networks.conditional_generator
+        discriminator_fn = networks.conditional_discriminator
+        generator_inputs = (noise, one_hot_labels)
 
     elif FLAGS.gan_type == 'infogan':
         cat_dim, cont_dim = 10, 2
@@ -119,11 +258,21 @@ def main(FLAGS):
         discriminator_fn = functools.partial(networks.infogan_discriminator,
                                              categorical_dim=cat_dim,
                                              continuous_dim=cont_dim)
-        unstructured_inputs, structured_inputs = util.get_infogan_noise(
+        _, structured_inputs = util.get_infogan_noise(
             FLAGS.batch_size,
             cat_dim,
             cont_dim,
             FLAGS.noise_dims)
+        unstructured_inputs = [_noise_buffer('unstructured_noise_buffer',
+                                             [FLAGS.batch_size,
+                                              FLAGS.noise_dims - cont_dim])]
+
+    if FLAGS.xla:
+        generator_fn = _jit_compiled(generator_fn)
+        discriminator_fn = _jit_compiled(discriminator_fn)
+
+    # Define the GANModel tuple.
+    if FLAGS.gan_type == 'infogan':
         gan_model = tfgan.infogan_model(generator_fn=generator_fn,
                                         discriminator_fn=discriminator_fn,
                                         real_data=images,
@@ -132,12 +281,20 @@ def main(FLAGS):
 
         mutual_information_penalty_weight = 1
 
+    else:
+        gan_model = tfgan.gan_model(generator_fn=generator_fn,
+                                    discriminator_fn=discriminator_fn,
+                                    real_data=images,
+                                    generator_inputs=generator_inputs)
+
     # tfgan.eval.add_gan_model_image_summaries(gan_model, FLAGS.grid_size)
 
-    # Write a summary that save the real images.
-    tf.summary.image('real_images',
-                     images[:, :, :, :3],
-                     max_outputs=2)
+    # Write a summary that save the real images. It is kept out of the default
+    # summary collection and written by its own, less frequent, hook.
+    image_summary_op = tf.summary.image('real_images',
+                                        images[:, :, :, :3],
+                                        max_outputs=2,
+                                        collections=[])
 
     # Get the GANLoss tuple. You can pass a custom function, use one of the
     # already-implemented losses from the losses library, or use the defaults.
@@ -161,28 +318,47 @@ def main(FLAGS):
         train_ops = tfgan.gan_train_ops(
             gan_model,
             gan_loss,
-            generator_optimizer=tf.train.AdamOptimizer(gen_lr, 0.5),
-            discriminator_optimizer=tf.train.AdamOptimizer(dis_lr, 0.5),
+            generator_optimizer=_optimizer(gen_lr,
+                                           FLAGS.dtype,
+                                           FLAGS.accum_steps),
+            discriminator_optimizer=_optimizer(dis_lr,
+                                               FLAGS.dtype,
+                                               FLAGS.accum_steps),
             summarize_gradients=True,
-            aggregation_method=tf.AggregationMethod.EXPERIMENTAL_ACCUMULATE_N)
+            colocate_gradients_with_ops=True,
+            aggregation_method=tf.AggregationMethod.ADD_N)
 
     # Run the alternating training loop. Skip it if no steps should be taken
     # (used for graph construction tests).
-    status_message = tf.string_join(
-        ['Starting train step: ',
-         tf.as_string(tf.train.get_or_create_global_step())],
-        name='status_message')
-
     if FLAGS.max_number_of_steps == 0:
 
         return
 
+    # Optionally let XLA auto-cluster and fuse the training step's kernels.
+    config = tf.ConfigProto()
+    if FLAGS.xla:
+        config.graph_options.optimizer_options.global_jit_level = (
+            tf.OptimizerOptions.ON_2)
+
+    # Initialize the input iterator alongside the default local initializers.
+    scaffold = tf.train.Scaffold(
+        local_init_op=tf.group(tf.train.Scaffold.default_local_init_op(),
+                               train_iterator.initializer))
+
     tfgan.gan_train(
         train_ops,
         hooks=[tf.train.StopAtStepHook(num_steps=FLAGS.max_number_of_steps),
-               tf.train.LoggingTensorHook([status_message], every_n_iter=10)],
+               tf.train.LoggingTensorHook({'step': tf.train.get_or_create_global_step()},
+                                          every_n_secs=30),
+               tf.train.SummarySaverHook(save_steps=FLAGS.image_summary_steps,
+                                         output_dir=FLAGS.train_log_dir,
+                                         summary_op=image_summary_op)],
         logdir=FLAGS.train_log_dir,
-        get_hooks_fn=tfgan.get_joint_train_hooks())
+        get_hooks_fn=tfgan.get_joint_train_hooks(),
+        scaffold=scaffold,
+        save_checkpoint_secs=FLAGS.save_checkpoint_secs,
+        save_summaries_steps=FLAGS.save_summaries_steps,
+        config=config)
 
 
 if __name__ == '__main__':
@@ -217,7 +393,9 @@ if __name__ == '__main__':
 
     parser.add_argument('--train_tfrecord', type=str,
                         default="desequenced_train_rn_16mc.tfrecords",
-                        help='Name of the training TFRecord file.')
+                        help='Name of the training TFRecord file, or a glob '
+                             'pattern over its shards. Sharding the records '
+                             'into ~16 files lets them be read in parallel.')
 
     parser.add_argument('--valid_tfrecord', type=str,
                         default="desequenced_valid_rn_16mc.tfrecords",
@@ -241,9 +419,20 @@ if __name__ == '__main__':
                         default=1000000,
                         help='The maximum number of gradient steps.')
 
+    parser.add_argument('--save_checkpoint_secs',
+                        type=int,
+                        default=600,
+                        help='Number of seconds between checkpoints.')
+
+    parser.add_argument('--save_summaries_steps',
+                        type=int,
+                        default=1000,
+                        help='Number of steps between summary writes.')
+
     parser.add_argument('--gpu_list', type=str,
                         default="0",
-                        help='GPUs to use with this model.')
+                        help='GPUs to use with this model. Training runs on '
+                             'the first GPU listed.')
 
     parser.add_argument('--gan_type',
                         type=str,
@@ -255,6 +444,11 @@ if __name__ == '__main__':
                         default=2,
                         help='Grid size for image visualization.')
 
+    parser.add_argument('--image_summary_steps',
+                        type=int,
+                        default=1000,
+                        help='Number of steps between real image summaries.')
+
     parser.add_argument('--noise_dims',
                         type=int,
                         default=64,
@@ -263,7 +457,9 @@ if __name__ == '__main__':
     parser.add_argument('--dataset_buffer_size',
                         type=int,
                         default=128,
-                        help='Number of images to prefetch in the input pipeline.')
+                        help='Shuffle buffer size, in images. Also the '
+                             'prefetch depth of each pipeline stage when '
+                             '--num_dataset_threads is non-negative.')
 
     parser.add_argument('--num_epochs',
                         type=int,
@@ -277,13 +473,23 @@ if __name__ == '__main__':
 
     parser.add_argument('--num_dataset_threads',
                         type=int,
-                        default=64,
-                        help='Number of threads to be used by the input pipeline.')
+                        default=-1,
+                        help='Number of threads to be used by the input pipeline. '
+                             'Negative values let tf.data autotune it.')
 
     parser.add_argument('--batch_size',
                         type=int,
-                        default=4,
-                        help='Batch size to use in training, validation, and testing/inference.')
+                        default=64,
+                        help='Batch size to use in training, validation, and testing/inference. '
+                             'Activation memory grows linearly with it; use '
+                             '--accum_steps to reach a large effective batch on '
+                             'smaller GPUs.')
+
+    parser.add_argument('--accum_steps',
+                        type=int,
+                        default=1,
+                        help='Number of batches whose gradients are averaged '
+                             'before each optimizer update.')
 
     parser.add_argument('--augment_train_data',
                         type=bool,
@@ -295,6 +501,40 @@ if __name__ == '__main__':
                         default=True,
                         help='If True, shuffle the training data')
 
+    parser.add_argument('--cache_train_data',
+                        dest='cache_train_data',
+                        action='store_true',
+                        help='Cache decoded training examples in memory '
+                             '(default)')
+
+    parser.add_argument('--no_cache_train_data',
+                        dest='cache_train_data',
+                        action='store_false',
+                        help='Re-read training examples from disk every '
+                             'epoch, for datasets too large for memory')
+
+    parser.set_defaults(cache_train_data=True)
+
+    parser.add_argument('--pre_casted',
+                        action='store_true',
+                        help='If True, the TFRecords were written by '
+                             'convert_tfrecord_float.py')
+
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='If True, print the shape of each image batch')
+
+    parser.add_argument('--xla',
+                        action='store_true',
+                        help='If True, compile the training step with XLA')
+
+    parser.add_argument('--dtype',
+                        type=str,
+                        default='fp32',
+                        choices=['fp32', 'fp16'],
+                        help='Compute precision: `fp32`, or `fp16` for '
+                             'automatic mixed precision with loss scaling.')
+
     FLAGS = parser.parse_args()
 
     # Launch training
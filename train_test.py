@@ -67,5 +67,54 @@ class TrainTest(tf.test.TestCase, parameterized.TestCase):
           mock_imgs, mock_lbls, None)
       train.main(None)
 
+
+class GradientAccumulationOptimizerTest(tf.test.TestCase):
+
+  def _assert_applies_every_accum_steps(self, train_op, var, accum_steps):
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      initial = sess.run(var)
+
+      # The variable is untouched while gradients accumulate.
+      for _ in range(accum_steps - 1):
+        sess.run(train_op)
+        self.assertAllClose(initial, sess.run(var))
+
+      # The last step applies the accumulated gradient once.
+      sess.run(train_op)
+      updated = sess.run(var)
+      self.assertTrue(np.all(updated < initial))
+
+      # Accumulation restarts from zero after the update.
+      for _ in range(accum_steps - 1):
+        sess.run(train_op)
+        self.assertAllClose(updated, sess.run(var))
+      return updated
+
+  def test_applies_mean_gradient_every_accum_steps(self):
+    accum_steps = 3
+    var = tf.Variable([1.0, 2.0])
+    grad = tf.constant([0.3, 0.6])
+    optimizer = train._GradientAccumulationOptimizer(
+        tf.train.AdamOptimizer(0.1), accum_steps)
+    train_op = optimizer.apply_gradients([(grad, var)])
+
+    # Adam's first step moves each variable by the learning rate.
+    updated = self._assert_applies_every_accum_steps(
+        train_op, var, accum_steps)
+    self.assertAllClose([0.9, 1.9], updated)
+
+  def test_fp16_optimizer_accumulates(self):
+    accum_steps = 2
+    var = tf.Variable([1.0, 2.0])
+    loss = tf.reduce_sum(var * tf.constant([0.3, 0.6]))
+    optimizer = train._optimizer(0.1, 'fp16', accum_steps)
+    self.addCleanup(
+        tf.train.experimental.disable_mixed_precision_graph_rewrite)
+    train_op = optimizer.minimize(loss, var_list=[var])
+
+    self._assert_applies_every_accum_steps(train_op, var, accum_steps)
+
+
 if __name__ == '__main__':
   tf.test.main()